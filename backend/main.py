@@ -1,19 +1,26 @@
 import asyncio
+from collections import Counter, deque
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.websockets import WebSocketState
 from google.cloud.speech import SpeechAsyncClient
 from google.cloud import speech
 import logging
+import orjson
 import os
-import time
 
 try:
     import webrtcvad 
 except Exception:  
     webrtcvad = None
 
+try:
+    import numpy as np
+except Exception:
+    np = None
+
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -28,6 +35,63 @@ app.add_middleware(
 # Use the SpeechAsyncClient
 client = SpeechAsyncClient()
 
+# Audio/VAD parameters
+sample_rate_hz = 16000
+frame_ms = 30
+bytes_per_sample = 2  # 16-bit PCM
+frame_bytes = int(sample_rate_hz * frame_ms / 1000) * bytes_per_sample
+
+# Tunables are read once per worker rather than per connection/result
+use_vad = bool(int(os.getenv("VAD_ENABLED", "1")))
+vad_aggressiveness = int(os.getenv("VAD_AGGRESSIVENESS", "2"))  # 0-3
+preroll_ms = int(os.getenv("VAD_PREROLL_MS", "150"))
+hangover_ms = int(os.getenv("VAD_HANGOVER_MS", "400"))
+# Frames whose RMS amplitude is below this floor are treated as unvoiced
+# without calling webrtcvad (0 disables the pre-gate)
+energy_floor = int(os.getenv("VAD_ENERGY_FLOOR", "50"))
+keepalive_sec = int(os.getenv("SILENCE_KEEPALIVE_MS", "250")) / 1000
+tail_words = int(os.getenv("VOTE_TAIL_WORDS", "5"))
+tail_weight = int(os.getenv("VOTE_TAIL_WEIGHT", "2"))
+# Bound on requests queued for gRPC per connection; when the uplink stalls, audio
+# frames pause websocket ingestion and silence keepalives are dropped
+audio_queue_max = max(1, int(os.getenv("AUDIO_QUEUE_MAX", "100")))
+# Streaming recognition caps each stream at ~5 minutes; rotate streams before that
+streaming_limit_sec = int(os.getenv("STREAMING_LIMIT_SEC", "290"))
+
+if use_vad and webrtcvad is None:
+    logger.warning("webrtcvad not available; disabling VAD gating.")
+    use_vad = False
+
+# Audio requests are built as raw protobuf messages and wrapped in place, which
+# skips the proto-plus constructor (marshalling/validation) on every frame
+streaming_request_pb = speech.StreamingRecognizeRequest.pb()
+
+
+def audio_request(audio_content):
+    return speech.StreamingRecognizeRequest.wrap(streaming_request_pb(audio_content=audio_content))
+
+
+# Transcript messages have fixed keys, so only the values are encoded per message
+# (orjson handles escaping of the transcript). The client JSON.parses text frames.
+def interim_payload(transcript):
+    return '{"transcript":' + orjson.dumps(transcript).decode() + ',"is_final":false}'
+
+
+def final_payload(speaker_tag, transcript):
+    return (
+        '{"speaker_tag":' + str(int(speaker_tag))
+        + ',"transcript":' + orjson.dumps(transcript).decode()
+        + ',"is_final":true}'
+    )
+
+
+# Silence keepalive payload is constant, so the request is built once per process
+zero_frame = b"\x00" * frame_bytes
+zero_frame_request = audio_request(zero_frame)
+
+# Recognition model, e.g. "video" or "phone_call" for telephony audio
+speech_model = os.getenv("SPEECH_MODEL", "video")
+
 diarization_config = speech.SpeakerDiarizationConfig(
     enable_speaker_diarization=True,
     min_speaker_count=2,
@@ -36,12 +100,12 @@ diarization_config = speech.SpeakerDiarizationConfig(
 
 config = speech.RecognitionConfig(
     encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-    sample_rate_hertz=16000,
+    sample_rate_hertz=sample_rate_hz,
     language_code="en-US",
     diarization_config=diarization_config,
     enable_automatic_punctuation=True,
     use_enhanced=True,
-    model="video",
+    model=speech_model,
     enable_word_time_offsets=True,
 )
 
@@ -54,79 +118,181 @@ streaming_config = speech.StreamingRecognitionConfig(
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
 
-    async def request_generator():
-        yield speech.StreamingRecognizeRequest(streaming_config=streaming_config)
-
-        # Audio/VAD parameters
-        sample_rate_hz = 16000
-        frame_ms = 30 
-        bytes_per_sample = 2  # 16-bit PCM
-        frame_bytes = int(sample_rate_hz * frame_ms / 1000) * bytes_per_sample
-
-        use_vad = bool(int(os.getenv("VAD_ENABLED", "1")))
-        vad_aggressiveness = int(os.getenv("VAD_AGGRESSIVENESS", "2"))  # 0-3
-        preroll_ms = int(os.getenv("VAD_PREROLL_MS", "150"))
-        hangover_ms = int(os.getenv("VAD_HANGOVER_MS", "400"))
-
-        if use_vad and webrtcvad is None:
-            logging.warning("webrtcvad not available; disabling VAD gating.")
-            use_vad = False
+    # Three-stage pipeline so the stages overlap instead of stalling each other:
+    # receiver (websocket -> VAD -> audio_q), request_generator (audio_q -> gRPC)
+    # and the responder (gRPC -> websocket). None on the queue marks end of audio.
+    audio_q = asyncio.Queue(maxsize=audio_queue_max)
+    audio_ended = False
 
+    async def request_generator(first_request, deadline, half_closed):
+        nonlocal audio_ended
+        loop = asyncio.get_running_loop()
+        try:
+            yield speech.StreamingRecognizeRequest(streaming_config=streaming_config)
+            yield first_request
+            while True:
+                # Half-close before the per-stream duration limit, even while VAD
+                # is holding back silence; the next stream continues from the queue
+                remaining_sec = deadline - loop.time()
+                if remaining_sec <= 0:
+                    return
+                try:
+                    request = await asyncio.wait_for(audio_q.get(), remaining_sec)
+                except TimeoutError:
+                    return
+                if request is None:
+                    audio_ended = True
+                    return
+                yield request
+        finally:
+            half_closed.set()
+
+    async def receive_audio():
         if not use_vad:
             try:
                 while True:
                     data = await websocket.receive_bytes()
-                    yield speech.StreamingRecognizeRequest(audio_content=data)
+                    await audio_q.put(audio_request(data))
             except WebSocketDisconnect:
-                logging.info("Client disconnected from websocket.")
-                return
+                logger.info("Client disconnected from websocket.")
+            await audio_q.put(None)
+            return
 
         # VAD setup
         vad = webrtcvad.Vad(vad_aggressiveness) if use_vad else None
-        buffer = bytearray()
+        # Incoming chunks are queued as memoryviews; frames are cut from the head
+        # using an offset cursor so buffered audio is never shifted or re-copied.
+        chunks = deque()
+        buffered = 0
+        head_off = 0
         speech_active = False
-        from collections import deque
         preroll_frames = max(1, preroll_ms // frame_ms)
         hangover_frames = max(1, hangover_ms // frame_ms)
-        preroll = deque(maxlen=preroll_frames)
+        # Preroll ring: fixed slots plus a write cursor, so silent frames are
+        # recorded without any per-frame container churn
+        preroll = [None] * preroll_frames
+        preroll_idx = 0
+        preroll_fill = 0
         unvoiced_count = 0
 
-        try:
-            # Use receive timeout to inject keepalive during long silence
-            recv_timeout_sec = max(0.02, frame_ms / 1000)
-            zero_frame = b"\x00" * frame_bytes
-            keepalive_ms = int(os.getenv("SILENCE_KEEPALIVE_MS", "250"))
-            last_client_data_ts = time.monotonic()
-            while True:
-                try:
-                    chunk = await asyncio.wait_for(websocket.receive_bytes(), timeout=recv_timeout_sec)
-                    buffer.extend(chunk)
-                    last_client_data_ts = time.monotonic()
-                except asyncio.TimeoutError:
-                    # No data from client; if not in speech and exceeded keepalive interval, send a zero frame
-                    if not speech_active and (time.monotonic() - last_client_data_ts) * 1000 >= keepalive_ms:
-                        yield speech.StreamingRecognizeRequest(audio_content=zero_frame)
+        def pop_frames(count):
+            # Returns the frames as segments: zero-copy windows over runs of whole
+            # frames inside one chunk, plus a joined copy of any single frame that
+            # straddles a chunk boundary (the frontend's 8192-byte chunks are not a
+            # multiple of the frame size)
+            nonlocal buffered, head_off
+            segments = []
+            buffered -= count * frame_bytes
+            while count:
+                head = chunks[0]
+                whole = min(count, (len(head) - head_off) // frame_bytes)
+                if whole:
+                    end = head_off + whole * frame_bytes
+                    segments.append(head[head_off:end])
+                    head_off = end
+                    count -= whole
+                    if head_off == len(head):
+                        chunks.popleft()
+                        head_off = 0
                     continue
 
-                while len(buffer) >= frame_bytes:
-                    frame = bytes(buffer[:frame_bytes])
-                    del buffer[:frame_bytes]
+                # Frame straddles chunk boundaries
+                parts = []
+                needed = frame_bytes
+                while needed:
+                    head = chunks[0]
+                    take = min(needed, len(head) - head_off)
+                    parts.append(head[head_off:head_off + take])
+                    needed -= take
+                    head_off += take
+                    if head_off == len(head):
+                        chunks.popleft()
+                        head_off = 0
+                segments.append(b"".join(parts))
+                count -= 1
+            return segments
+
+        def classify_block(segments):
+            # The one copy per frame: materialize bytes for webrtcvad and the request
+            # (bytes() of an already-joined straddling frame returns it as is)
+            frames = [
+                bytes(seg[i:i + frame_bytes])
+                for seg in segments
+                for i in range(0, len(seg), frame_bytes)
+            ]
+            return frames, classify_frames(segments, frames)
+
+        def classify_frames(segments, frames):
+            if np is None or energy_floor <= 0:
+                # Digital silence (e.g. the client's zero-filled keepalives) is
+                # rejected with a memcmp against the shared zero frame
+                return [f != zero_frame and vad.is_speech(f, sample_rate_hz) for f in frames]
+
+            # One vectorized energy pass over all frames (one or more);
+            # only frames above the floor are confirmed by webrtcvad
+            samples = np.concatenate(
+                [np.frombuffer(seg, dtype="<i2") for seg in segments], dtype=np.int32
+            ).reshape(len(frames), -1)
+            rms2 = (samples * samples).mean(axis=1)
+            loud = (rms2 >= energy_floor * energy_floor).tolist()
+            return [
+                is_loud and vad.is_speech(f, sample_rate_hz)
+                for f, is_loud in zip(frames, loud)
+            ]
+
+        # Keepalive during long silence: a single timer injects zero frames into the
+        # queue instead of putting a timeout on every websocket read
+        loop = asyncio.get_running_loop()
+        keepalive_interval_sec = max(0.02, frame_ms / 1000)
+        last_client_data_ts = loop.time()
+
+        def keepalive_tick():
+            nonlocal keepalive_handle
+            idle_sec = loop.time() - last_client_data_ts
+            if idle_sec < keepalive_sec:
+                delay = keepalive_sec - idle_sec
+            else:
+                # No data from client past the keepalive interval; send zero frames while not in speech.
+                # A full queue means gRPC is behind on real audio, so the keepalive is dropped
+                # rather than evicting queued audio
+                if not speech_active and not audio_q.full():
+                    audio_q.put_nowait(zero_frame_request)
+                delay = keepalive_interval_sec
+            keepalive_handle = loop.call_later(delay, keepalive_tick)
+
+        keepalive_handle = loop.call_later(keepalive_sec, keepalive_tick)
 
-                    is_speech = vad.is_speech(frame, sample_rate_hz)
+        try:
+            while True:
+                chunk = await websocket.receive_bytes()
+                last_client_data_ts = loop.time()
+                if chunk:
+                    chunks.append(memoryview(chunk))
+                    buffered += len(chunk)
+
+                n_frames = buffered // frame_bytes
+                if not n_frames:
+                    continue
+                frames, speech_flags = classify_block(pop_frames(n_frames))
 
+                for frame, is_speech in zip(frames, speech_flags):
                     if not speech_active:
-                        preroll.append(frame)
+                        preroll[preroll_idx] = frame
+                        preroll_idx = (preroll_idx + 1) % preroll_frames
+                        if preroll_fill < preroll_frames:
+                            preroll_fill += 1
                         if is_speech:
                             speech_active = True
                             unvoiced_count = 0
-                            # Flush preroll first, then current frame
-                            for f in list(preroll):
-                                yield speech.StreamingRecognizeRequest(audio_content=f)
-                            preroll.clear()
-                            yield speech.StreamingRecognizeRequest(audio_content=frame)
+                            # Flush preroll first (oldest to newest), then current frame
+                            while preroll_fill:
+                                slot = (preroll_idx - preroll_fill) % preroll_frames
+                                preroll_fill -= 1
+                                await audio_q.put(audio_request(preroll[slot]))
+                            await audio_q.put(audio_request(frame))
                     else:
                         # In active speech: always forward frames
-                        yield speech.StreamingRecognizeRequest(audio_content=frame)
+                        await audio_q.put(audio_request(frame))
 
                         if is_speech:
                             unvoiced_count = 0
@@ -135,17 +301,40 @@ async def websocket_endpoint(websocket: WebSocket):
                             if unvoiced_count >= hangover_frames:
                                 speech_active = False
                                 unvoiced_count = 0
-                                preroll.clear()
+                                preroll_fill = 0
         except WebSocketDisconnect:
-            logging.info("Client disconnected from websocket.")
-            return
-
-    try:
-        requests = request_generator()
+            logger.info("Client disconnected from websocket.")
+        finally:
+            keepalive_handle.cancel()
+        await audio_q.put(None)
+
+    async def send_transcripts():
+        nonlocal audio_ended
+        # Long calls rotate onto a fresh stream over the shared client channel
+        # until the client stops sending audio. The next stream is opened as soon
+        # as the previous one half-closes and there is audio for it, so audio keeps
+        # flowing while the old stream's last results drain, but no stream is
+        # opened (and left idle) while VAD is holding back silence.
+        async with asyncio.TaskGroup() as streams:
+            while not audio_ended:
+                first_request = await audio_q.get()
+                if first_request is None:
+                    audio_ended = True
+                    break
+                half_closed = asyncio.Event()
+                stream = streams.create_task(transcribe_stream(first_request, half_closed))
+                # Also covers streams that end (or fail) before their generator returns
+                stream.add_done_callback(lambda _, event=half_closed: event.set())
+                await half_closed.wait()
+
+    async def transcribe_stream(first_request, half_closed):
+        deadline = asyncio.get_running_loop().time() + streaming_limit_sec
+        requests = request_generator(first_request, deadline, half_closed)
         responses = await client.streaming_recognize(requests=requests)
 
         # Using per-result majority vote only (no cross-result confirmation)
-        # Track last max word end time to avoid emitting duplicate finals
+        # Track last max word end time to avoid emitting duplicate finals;
+        # word offsets restart with each stream
         last_max_word_end_ns = None
         async for response in responses:
             for result in response.results:
@@ -153,111 +342,91 @@ async def websocket_endpoint(websocket: WebSocket):
                     if not result.alternatives or not result.alternatives[0].words:
                         continue
 
-                    words = result.alternatives[0].words
-                    transcript = result.alternatives[0].transcript
+                    alternative = result.alternatives[0]
+                    transcript = alternative.transcript
 
                     # Skip empty/whitespace transcripts
                     if not transcript or not transcript.strip():
                         continue
 
+                    # Snapshot words once as (speaker_tag, end_ns) tuples read from the raw
+                    # protobuf, where end_time is a Duration with seconds/nanos; the vote,
+                    # logging and duplicate check below only touch these plain values
+                    word_snapshot = [
+                        (w.speaker_tag, w.end_time.seconds * 1_000_000_000 + w.end_time.nanos)
+                        for w in speech.SpeechRecognitionAlternative.pb(alternative).words
+                    ]
+                    tags_sequence, end_times_ns = zip(*word_snapshot)
+                    current_max_end_ns = max(end_times_ns)
+
                     # Skip duplicates: if max end time hasn't advanced, this is likely a repeated final
-                    try:
-                        def to_ns(d):
-                            # d is a Duration with seconds and nanos
-                            return int(getattr(d, 'seconds', 0)) * 1_000_000_000 + int(getattr(d, 'nanos', 0))
-
-                        current_max_end_ns = max(
-                            [to_ns(getattr(w, 'end_time', None)) for w in words if getattr(w, 'end_time', None) is not None] or [None]
-                        )
-                        if current_max_end_ns is not None and last_max_word_end_ns is not None and current_max_end_ns <= last_max_word_end_ns:
-                            continue
-                        if current_max_end_ns is not None:
-                            last_max_word_end_ns = current_max_end_ns
-                    except Exception:
-                        pass
-
-                    # Prepare per-word tag sequence for readable logging later
-                    tags_sequence = [getattr(w, 'speaker_tag', None) for w in words]
+                    if last_max_word_end_ns is not None and current_max_end_ns <= last_max_word_end_ns:
+                        continue
+                    last_max_word_end_ns = current_max_end_ns
 
                     # Majority vote over word-level speaker_tag within this final segment
                     # with extra weight on trailing words to stabilize speaker at segment end
-                    tag_counts = {}
-                    for w in words:
-                        tag = getattr(w, 'speaker_tag', None)
-                        if tag is None:
-                            continue
-                        tag_counts[tag] = tag_counts.get(tag, 0) + 1
-
-                    pre_weight_counts = dict(tag_counts)
+                    pre_weight_counts = Counter(tags_sequence)
+                    tag_counts = pre_weight_counts.copy()
 
                     # Tail weighting: last N words get additional weight (e.g., count double)
-                    tail_words = int(os.getenv("VOTE_TAIL_WORDS", "5"))
-                    tail_weight = int(os.getenv("VOTE_TAIL_WEIGHT", "2"))
                     if tail_weight > 1 and tail_words > 0:
-                        start_idx = max(0, len(words) - tail_words)
-                        for w in words[start_idx:]:
-                            tag = getattr(w, 'speaker_tag', None)
-                            if tag is None:
-                                continue
+                        for tag in tags_sequence[-tail_words:]:
                             # add (tail_weight - 1) so total equals base 1 + extra
-                            tag_counts[tag] = tag_counts.get(tag, 0) + (tail_weight - 1)
-
-                    # We'll log a readable block after choosing the speaker_tag
-
-                    if not tag_counts:
-                        continue
+                            tag_counts[tag] += tail_weight - 1
 
                     # Per-result majority winner
-                    speaker_tag = max(tag_counts.items(), key=lambda kv: kv[1])[0]
+                    speaker_tag = tag_counts.most_common(1)[0][0]
 
                     # Pretty segment log: transcript, per-word tags spaced, counts (pre/weighted), and chosen tag
-                    try:
-                        # chunk tags into readable rows
-                        chunk_size = 32
-                        tag_rows = [
-                            " ".join(str(t) for t in tags_sequence[i:i+chunk_size])
-                            for i in range(0, len(tags_sequence), chunk_size)
-                        ]
-                        logging.info(
-                            "\n==== Diarization Segment ====\n"
-                            "Transcript: %s\n"
-                            "Tags (by word):\n  %s\n"
-                            "Counts (pre-weight): %s\n"
-                            "Counts (weighted, last %d x%d): %s\n"
-                            "Chosen speaker_tag: %s\n"
-                            "============================\n",
-                            transcript,
-                            "\n  ".join(tag_rows) if tag_rows else "",
-                            pre_weight_counts,
-                            tail_words,
-                            tail_weight,
-                            tag_counts,
-                            speaker_tag,
-                        )
-                    except Exception:
-                        pass
+                    if logger.isEnabledFor(logging.INFO):
+                        try:
+                            # chunk tags into readable rows
+                            chunk_size = 32
+                            tag_rows = [
+                                " ".join(str(t) for t in tags_sequence[i:i+chunk_size])
+                                for i in range(0, len(tags_sequence), chunk_size)
+                            ]
+                            logger.info(
+                                "\n==== Diarization Segment ====\n"
+                                "Transcript: %s\n"
+                                "Tags (by word):\n  %s\n"
+                                "Counts (pre-weight): %s\n"
+                                "Counts (weighted, last %d x%d): %s\n"
+                                "Chosen speaker_tag: %s\n"
+                                "============================\n",
+                                transcript,
+                                "\n  ".join(tag_rows) if tag_rows else "",
+                                pre_weight_counts,
+                                tail_words,
+                                tail_weight,
+                                tag_counts,
+                                speaker_tag,
+                            )
+                        except Exception:
+                            pass
 
                     # Send interim results for real-time feedback
                     if websocket.client_state == WebSocketState.CONNECTED:
-                        await websocket.send_json({
-                            "transcript": transcript,
-                            "is_final": False
-                        })
+                        await websocket.send_text(interim_payload(transcript))
 
-                    logging.info(f"Sending final transcript: Tag {speaker_tag} - {transcript}")
+                    logger.info("Sending final transcript: Tag %s - %s", speaker_tag, transcript)
 
                     # Send the raw speaker_tag, not a pre-determined label
                     if websocket.client_state == WebSocketState.CONNECTED:
-                        await websocket.send_json({
-                            "speaker_tag": speaker_tag, # Changed from "speaker"
-                            "transcript": transcript,
-                            "is_final": True
-                        })
+                        await websocket.send_text(final_payload(speaker_tag, transcript))
                     else:
-                        logging.warning("WebSocket is closed; unable to send final transcript.")
+                        logger.warning("WebSocket is closed; unable to send final transcript.")
 
-    except Exception as e:
-        if not isinstance(e, WebSocketDisconnect):
-                logging.error(f"An error occurred: {e}", exc_info=True)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            receiver = tg.create_task(receive_audio())
+            await send_transcripts()
+            receiver.cancel()
+    except* WebSocketDisconnect:
+        pass
+    except* Exception as eg:
+        for e in eg.exceptions:
+            logger.error("An error occurred: %s", e, exc_info=e)
     finally:
-        logging.info("Connection processing finished.")
+        logger.info("Connection processing finished.")